@@ -0,0 +1,24 @@
+"""amount nonneg check
+
+Revision ID: b2f4c6d8e0a1
+Revises: 8036f360f477
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2f4c6d8e0a1'
+down_revision: Union[str, None] = '8036f360f477'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_check_constraint('ck_amount_nonneg', 'wallets', 'amount >= 0')
+
+
+def downgrade() -> None:
+    op.drop_constraint('ck_amount_nonneg', 'wallets', type_='check')
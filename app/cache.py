@@ -0,0 +1,8 @@
+from cachetools import TTLCache
+from decouple import config
+
+# Кэш состояний кошельков в памяти процесса: UUID -> данные ответа WalletResponse в JSON-виде
+wallet_cache = TTLCache(
+    maxsize=config('WALLET_CACHE_SIZE', default=10000, cast=int),
+    ttl=config('WALLET_CACHE_TTL', default=5, cast=int),
+)
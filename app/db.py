@@ -1,8 +1,11 @@
+import asyncio
+from contextlib import AsyncExitStack
+
 from decouple import config
 from sqlalchemy import create_engine, text
-from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
-                                    create_async_engine)
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import (AsyncSession, async_scoped_session,
+                                    async_sessionmaker, create_async_engine)
+from sqlalchemy.orm import DeclarativeBase
 
 user = config('POSTGRES_USER')
 password = config('POSTGRES_PASSWORD')
@@ -10,23 +13,67 @@ host = config('POSTGRES_HOST')
 port = config('POSTGRES_PORT')
 dbname = config('POSTGRES_DB')
 
-# Создаем движок для подключения без указания базы данных
-default_engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/postgres")
-
-# Создаем базу данных, если она не существует
-with default_engine.connect() as conn:
-    conn = conn.execution_options(isolation_level="AUTOCOMMIT")
-    # Проверяем, существует ли база данных
-    result = conn.execute(text(f"SELECT 1 FROM pg_database WHERE datname = '{dbname}'"))
-    exists = result.scalar() is not None
-    # Создаем базу данных, если она не существует
-    if not exists:
-        conn.execute(text(f"CREATE DATABASE {dbname}"))
-
 DATABASE_URL = f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{dbname}"
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Параметры пула соединений
+pool_size = config('DB_POOL_SIZE', default=20, cast=int)
+max_overflow = config('DB_MAX_OVERFLOW', default=40, cast=int)
+pool_timeout = config('DB_POOL_TIMEOUT', default=5, cast=int)
+pool_recycle = config('DB_POOL_RECYCLE', default=3600, cast=int)
+# Открывать соединения пула при запуске приложения
+pool_prewarm = config('DB_POOL_PREWARM', default=True, cast=bool)
+# Логирование SQL-запросов (только для отладки)
+echo = config('DB_ECHO', default=False, cast=bool)
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=echo,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=pool_timeout,
+    pool_recycle=pool_recycle,
+    pool_pre_ping=True,
+)
 
 async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
-Base = declarative_base()
+# Сессия привязана к задаче asyncio: весь код одного запроса работает с одной сессией
+scoped_session = async_scoped_session(async_session, scopefunc=asyncio.current_task)
+
+
+class Base(DeclarativeBase):
+    """ Базовый класс моделей """
+
+
+async def warm_up_pool() -> None:
+    """ Заполнение пула соединениями, чтобы первые запросы не ждали подключения к базе """
+
+    # Держим все соединения открытыми одновременно, иначе пул будет отдавать одно и то же.
+    # TaskGroup при ошибке отменяет остальные подключения и дожидается их, прежде чем стек закроет открытые
+    async with AsyncExitStack() as stack:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(pool_size):
+                tg.create_task(stack.enter_async_context(engine.connect()))
+
+
+def create_database(user: str, password: str, host: str, port: str, dbname: str) -> None:
+    """ Создание базы данных, если она не существует """
+
+    # Создаем движок для подключения без указания базы данных
+    default_engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/postgres")
+
+    with default_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Проверяем, существует ли база данных
+        result = conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :dbname"), {'dbname': dbname})
+        exists = result.scalar() is not None
+        # Создаем базу данных, если она не существует
+        if not exists:
+            conn.execute(text(f"CREATE DATABASE {conn.dialect.identifier_preparer.quote(dbname)}"))
+
+    default_engine.dispose()
+
+
+if __name__ == '__main__':
+    # Запускается один раз перед миграциями: "python -m app.db"
+    create_database(user, password, host, port, dbname)
@@ -1,36 +1,103 @@
+import asyncio
+import operator
+import random
 from contextlib import asynccontextmanager
 from uuid import UUID
 
-from fastapi import Depends, FastAPI, HTTPException, status
-from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from decouple import config
+from fastapi import Depends, FastAPI, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import bindparam, lambda_stmt, update
+from sqlalchemy.exc import DBAPIError, IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from app.bearer import verify_token
-from app.db import Base, async_session, engine
+from app.cache import wallet_cache
+from app.db import Base, engine, pool_prewarm, scoped_session, warm_up_pool
 from app.models import Wallet
 from app.schemas import OperationType, WalletOperation, WalletResponse
 
+# SQLSTATE ошибок, после которых операцию можно безопасно повторить (дедлок, конфликт сериализации)
+RETRY_SQLSTATES = {'40P01', '40001'}
+# SQLSTATE нарушения CHECK-ограничения
+CHECK_VIOLATION = '23514'
+
+# Изменение баланса для каждого типа операции
+AMOUNT_CHANGES = {
+    OperationType.DEPOSIT: operator.add,
+    OperationType.WITHDRAW: operator.sub,
+}
+
+# Колонки для списков: строки Core без создания ORM-объектов и identity map
+WALLET_COLUMNS = (Wallet.id, Wallet.UUID, Wallet.amount)
+
+# Запрос кошелька по UUID: строится и компилируется один раз, далее берётся из кэша SQLAlchemy
+GET_WALLET = lambda_stmt(lambda: select(Wallet).where(Wallet.UUID == bindparam('wallet_uuid')))
+
 
 async def get_session() -> AsyncSession:
-    """ Создаём сессию """
-    async with async_session() as session:
-        yield session
+    """ Сессия текущего запроса """
+    try:
+        yield scoped_session()
+    finally:
+        # Закрываем сессию и убираем её из реестра задачи
+        await scoped_session.remove()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """ Управление запуском и завершением """
-    # Создаём таблиц при запуске приложения
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Схема создаётся миграциями Alembic; create_all - только для локального запуска без миграций
+    if config('DB_CREATE_TABLES', default=False, cast=bool):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    # Открываем соединения заранее
+    if pool_prewarm:
+        await warm_up_pool()
     yield
     # При завершении приложения закрываем соединения
     await engine.dispose()
 
 
 # Создаём приложение
-app = FastAPI(lifespan=lifespan, title='API для взаимодействия с кошельком', version="1.0.0")
+app = FastAPI(lifespan=lifespan, title='API для взаимодействия с кошельком', version="1.0.0",
+              default_response_class=ORJSONResponse)
+
+
+@app.get('/api/v1/wallets',
+         response_model=list[WalletResponse],
+         summary='Получение списка кошельков',
+         dependencies=[Depends(verify_token)],
+         tags=['Работа с кошельком'])
+async def get_wallets(limit: int = Query(100, ge=1, le=1000), offset: int = Query(0, ge=0),
+                      db: AsyncSession = Depends(get_session)):
+    """ Получение списка кошельков постранично """
+
+    # Запрос в базу, порядок по id для стабильной пагинации
+    query = select(*WALLET_COLUMNS).order_by(Wallet.id).limit(limit).offset(offset)
+    # Ждём результат запроса
+    result = await db.execute(query)
+
+    return result.all()
+
+
+@app.get('/api/v1/wallets/batch',
+         response_model=list[WalletResponse],
+         summary='Получение состояния нескольких кошельков по списку UUID',
+         dependencies=[Depends(verify_token)],
+         tags=['Работа с кошельком'])
+async def get_wallets_batch(uuids: list[UUID] = Query(..., max_length=100),
+                            db: AsyncSession = Depends(get_session)):
+    """ Получение кошельков по списку UUID одним запросом """
+
+    # Запрос в базу
+    query = select(*WALLET_COLUMNS).where(Wallet.UUID.in_(uuids))
+    # Ждём результат запроса
+    result = await db.execute(query)
+
+    # Несуществующие кошельки в ответ не попадают
+    return result.all()
 
 
 @app.get('/api/v1/wallets/{wallet_uuid}',
@@ -38,24 +105,20 @@ app = FastAPI(lifespan=lifespan, title='API для взаимодействия
          summary='Получение состояния кошелька по UUID',
          dependencies=[Depends(verify_token)],
          tags=['Работа с кошельком'])
-async def get_wallet(wallet_uuid: str, db: AsyncSession = Depends(get_session)):
+async def get_wallet(wallet_uuid: UUID, from_cache: bool = False, db: AsyncSession = Depends(get_session)):
     """ Получение кошелька по UUID """
 
-    # Проверяем корректность UUID
-    try:
-        wallet_uuid = UUID(wallet_uuid)
-    except ValueError:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail='Неверный формат UUID'
-        )
+    # Клиент допускает ответ из кэша (устаревший не более чем на WALLET_CACHE_TTL секунд)
+    if from_cache:
+        cached = wallet_cache.get(wallet_uuid)
+        if cached is not None:
+            # Готовые данные ответа отдаём напрямую, без повторной валидации response_model
+            return ORJSONResponse(cached)
 
-    # Запрос в базу
-    query = select(Wallet).where(Wallet.UUID == wallet_uuid)
-    # Ждём результат запроса
-    result = await db.execute(query)
+    # Запрос в базу, ждём результат
+    result = await db.execute(GET_WALLET, {'wallet_uuid': wallet_uuid})
     # Забираем единственный результат
-    wallet = result.scalars().first()
+    wallet = result.scalar_one_or_none()
 
     # Если кошелька нет - исключение
     if not wallet:
@@ -64,6 +127,9 @@ async def get_wallet(wallet_uuid: str, db: AsyncSession = Depends(get_session)):
             detail='Кошелек не найден'
         )
 
+    # Кладём в кэш сериализованные данные ответа
+    wallet_cache[wallet_uuid] = WalletResponse.model_validate(wallet).model_dump(mode='json')
+
     return wallet
 
 
@@ -72,86 +138,81 @@ async def get_wallet(wallet_uuid: str, db: AsyncSession = Depends(get_session)):
           summary='Движение средств по UUID кошелька',
           dependencies=[Depends(verify_token)],
           tags=['Работа с кошельком'])
-async def operations_with_wallet(wallet_uuid: str, operation: WalletOperation, db: AsyncSession = Depends(get_session)):
+async def operations_with_wallet(wallet_uuid: UUID, operation: WalletOperation,
+                                 db: AsyncSession = Depends(get_session)):
     """ Движение средств по UUID кошелька """
 
-    # Проверяем корректность UUID
-    try:
-        wallet_uuid = UUID(wallet_uuid)
-    except ValueError:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail='Неверный формат UUID'
-        )
-
     max_retries = 5
     for attempt in range(max_retries):
         try:
-            async with db.begin():
-                # Запрос в базу
-                query = select(Wallet).where(Wallet.UUID == wallet_uuid).with_for_update()
-                # Ждём результат запроса
-                result = await db.execute(query)
-                # Забираем единственный результат
-                wallet = result.scalars().first()
+            # Изменяем баланс одним атомарным запросом, без предварительного чтения и блокировки строки
+            new_amount = AMOUNT_CHANGES[operation.operationType](Wallet.amount, operation.amount)
+            query = update(Wallet).where(Wallet.UUID == wallet_uuid).values(amount=new_amount)
+            if operation.operationType is OperationType.WITHDRAW:
+                # Списываем только при достаточном остатке; CHECK-ограничение базы - страховка
+                query = query.where(Wallet.amount >= operation.amount)
+            query = query.returning(Wallet).execution_options(synchronize_session=False)
+            # Ждём результат запроса
+            result = await db.execute(query)
+            # Забираем обновлённый кошелек
+            wallet = result.scalar_one_or_none()
+
+            if not wallet:
+                # Строка не обновлена - проверяем, существует ли кошелек, и завершаем транзакцию
+                result = await db.execute(GET_WALLET, {'wallet_uuid': wallet_uuid})
+                await db.rollback()
 
                 # Если кошелька нет - исключение
-                if not wallet:
+                if result.scalar_one_or_none() is None:
                     raise HTTPException(
                         status_code=status.HTTP_404_NOT_FOUND,
                         detail='Кошелек не найден'
                     )
-                # Проверяем переданное значение
-                if operation.operationType == OperationType.DEPOSIT:
-                    wallet.amount += operation.amount
-                elif operation.operationType == OperationType.WITHDRAW:
-                    if wallet.amount < operation.amount:
-                        raise HTTPException(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            detail='Недостаточно средств для снятия'
-                        )
-                    wallet.amount -= operation.amount
-                db.add(wallet)
-
-            # Обновляем запись в базе
+                # Кошелек есть, но средств недостаточно
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail='Недостаточно средств для снятия'
+                )
+
+            # Фиксируем изменения и сбрасываем кэш
             await db.commit()
+            wallet_cache.pop(wallet_uuid, None)
+
+            return wallet
 
-            # Выходим из цикла при успешной операции
-            break
+        except IntegrityError as e:
+            await db.rollback()
+            # Нарушено ограничение amount >= 0
+            if getattr(e.orig, 'sqlstate', None) == CHECK_VIOLATION:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail='Недостаточно средств для снятия'
+                ) from e
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail='Произошла ошибка при обработке операции'
+            ) from e
 
-        except OperationalError as e:
-            # Обработка дедлоков и других ошибок
+        except DBAPIError as e:
             await db.rollback()
-            if "deadlock detected" in str(e).lower():
+            # Дедлок или конфликт сериализации - повторяем с экспоненциальной задержкой
+            if getattr(e.orig, 'sqlstate', None) in RETRY_SQLSTATES:
                 if attempt < max_retries - 1:
-                    continue  # Повторяем попытку
-                else:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail='Системная ошибка, попробуйте позже'
-                    )
-            else:
+                    await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+                    continue
+                # Если все попытки исчерпаны
                 raise HTTPException(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail='Произошла ошибка при обработке операции'
+                    detail='Системная ошибка, попробуйте позже'
                 ) from e
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail='Произошла ошибка при обработке операции'
+            ) from e
 
-        # Проброс исключений
-        except HTTPException as e:
-            raise e
-
-        except SQLAlchemyError:
+        except SQLAlchemyError as e:
             await db.rollback()
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail='Произошла ошибка при обработке операции'
-            ) from SQLAlchemyError
-
-    else:
-        # Если все попытки исчерпаны
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail='Не удалось обработать операцию после нескольких попыток'
-        )
-
-    return wallet
+            ) from e
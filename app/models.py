@@ -1,4 +1,8 @@
-from sqlalchemy import DECIMAL, UUID, Column, Integer
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import DECIMAL, UUID, CheckConstraint
+from sqlalchemy.orm import Mapped, mapped_column
 
 from app.db import Base
 
@@ -6,7 +10,11 @@ from app.db import Base
 class Wallet(Base):
     """ Модель кошелька """
     __tablename__ = 'wallets'
+    __table_args__ = (
+        # Баланс не может уйти в минус - проверяется самой базой
+        CheckConstraint('amount >= 0', name='ck_amount_nonneg'),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    UUID = Column(UUID(as_uuid=True), unique=True, nullable=False, index=True)
-    amount = Column(DECIMAL(10, 2), nullable=False, default=0)
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    UUID: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), unique=True, index=True)
+    amount: Mapped[Decimal] = mapped_column(DECIMAL(10, 2), default=0)
@@ -1,7 +1,7 @@
 from decimal import Decimal
 from enum import Enum
 
-from pydantic import UUID4, BaseModel, ConfigDict
+from pydantic import UUID4, BaseModel, ConfigDict, Field
 
 
 class OperationType(str, Enum):
@@ -19,6 +19,6 @@ class WalletResponse(BaseModel):
 
 class WalletOperation(BaseModel):
     operationType: OperationType
-    amount: Decimal
+    amount: Decimal = Field(gt=0)
 
     model_config = ConfigDict(from_attributes=True)
@@ -1,18 +1,21 @@
+import asyncio
+import warnings
+from contextlib import asynccontextmanager
 from unittest.mock import patch
 
 import pytest
 import pytest_asyncio
 from decouple import config
-from fastapi import HTTPException
 from httpx import ASGITransport, AsyncClient
-from sqlalchemy.exc import OperationalError, SQLAlchemyError
-from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
-                                    create_async_engine)
-from sqlalchemy.sql import select, text
-from sqlalchemy import create_engine
-
-from app.db import Base
-from app.main import app, get_session, get_wallet
+from sqlalchemy.exc import (DBAPIError, IntegrityError, OperationalError,
+                            SAWarning, SQLAlchemyError)
+from sqlalchemy.ext.asyncio import (AsyncSession, async_scoped_session,
+                                    async_sessionmaker, create_async_engine)
+from sqlalchemy.sql import select, text, update
+
+from app.cache import wallet_cache
+from app.db import Base, create_database, warm_up_pool
+from app.main import app, get_session
 from app.models import Wallet
 
 user = config('POSTGRES_USER_TEST')
@@ -22,18 +25,8 @@ port = config('POSTGRES_PORT_TEST')
 dbname = config('POSTGRES_DB_TEST')
 DATABASE_URL_TEST = f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{dbname}"
 
-# Создаем движок для подключения без указания базы данных
-default_engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/postgres")
-
-# Создаем базу данных, если она не существует
-with default_engine.connect() as conn:
-    conn = conn.execution_options(isolation_level="AUTOCOMMIT")
-    # Проверяем, существует ли база данных
-    result = conn.execute(text(f"SELECT 1 FROM pg_database WHERE datname = '{dbname}'"))
-    exists = result.scalar() is not None
-    # Создаем базу данных, если она не существует
-    if not exists:
-        conn.execute(text(f"CREATE DATABASE {dbname}"))
+# Создаем тестовую базу данных, если она не существует
+create_database(user, password, host, port, dbname)
 
 # Создание асинхронного движка для тестовой базы данных
 test_engine = create_async_engine(DATABASE_URL_TEST, echo=False, future=True)
@@ -65,10 +58,11 @@ async def client(setup_database):
     """ Фикстура для клиента HTTPX и очистки таблиц перед каждым тестом """
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
-        # Очистка таблицы wallets перед каждым тестом
+        # Очистка таблицы wallets и кэша перед каждым тестом
         async with TestSessionLocal() as session:
             await session.execute(text('TRUNCATE TABLE wallets RESTART IDENTITY CASCADE;'))
             await session.commit()
+        wallet_cache.clear()
         yield client
 
 
@@ -113,6 +107,199 @@ async def test_get_wallet(client, bearer_key):
     assert data['UUID'] == '1a88911f-3345-4963-bd73-0f76dbf27a1d'
 
 
+@pytest.mark.asyncio
+async def test_get_wallet_from_cache(client, bearer_key):
+    """Тестирование GET /api/v1/wallets/{wallet_uuid}?from_cache=true"""
+    # Предварительная подготовка данных в базе
+    async with TestSessionLocal() as session:
+        wallet = Wallet(
+            UUID='2b88911f-3345-4963-bd73-0f76dbf27a2b',
+            amount=100.0
+        )
+        session.add(wallet)
+        await session.commit()
+
+    response = await client.get(
+        "/api/v1/wallets/2b88911f-3345-4963-bd73-0f76dbf27a2b",
+        headers={"Authorization": bearer_key}
+    )
+    assert response.status_code == 200
+    data = response.json()
+
+    # Меняем баланс в обход API
+    async with TestSessionLocal() as session:
+        await session.execute(update(Wallet).values(amount=200.0))
+        await session.commit()
+
+    # Из кэша отдаётся прежнее значение, без кэша - актуальное
+    response = await client.get(
+        "/api/v1/wallets/2b88911f-3345-4963-bd73-0f76dbf27a2b?from_cache=true",
+        headers={"Authorization": bearer_key}
+    )
+    assert response.status_code == 200
+    assert response.json() == data  # Ответ из кэша совпадает с исходным
+    assert response.json()['amount'] == '100.00'
+
+    response = await client.get(
+        "/api/v1/wallets/2b88911f-3345-4963-bd73-0f76dbf27a2b",
+        headers={"Authorization": bearer_key}
+    )
+    assert response.json()['amount'] == '200.00'
+
+    # Операция с кошельком сбрасывает кэш
+    response = await client.post(
+        "/api/v1/wallets/2b88911f-3345-4963-bd73-0f76dbf27a2b/operation",
+        headers={"Authorization": bearer_key}, json={"operationType": "DEPOSIT", "amount": 1})
+    assert response.status_code == 200
+
+    response = await client.get(
+        "/api/v1/wallets/2b88911f-3345-4963-bd73-0f76dbf27a2b?from_cache=true",
+        headers={"Authorization": bearer_key}
+    )
+    assert response.json()['amount'] == '201.00'
+
+
+@pytest.mark.asyncio
+async def test_get_wallets(client, bearer_key):
+    """Тестирование эндпоинта GET /api/v1/wallets с пагинацией"""
+    # Предварительная подготовка данных в базе
+    async with TestSessionLocal() as session:
+        session.add_all([
+            Wallet(UUID='1a88911f-3345-4963-bd73-0f76dbf27a1d', amount=100.0),
+            Wallet(UUID='2b88911f-3345-4963-bd73-0f76dbf27a2b', amount=200.0),
+            Wallet(UUID='3c88911f-3345-4963-bd73-0f76dbf27a3c', amount=300.0),
+        ])
+        await session.commit()
+
+    response = await client.get(
+        "/api/v1/wallets",
+        params={"limit": 2, "offset": 1},
+        headers={"Authorization": bearer_key}
+    )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [wallet['amount'] for wallet in data] == ['200.00', '300.00']
+
+    response = await client.get(
+        "/api/v1/wallets",
+        params={"limit": 0},
+        headers={"Authorization": bearer_key}
+    )
+
+    assert response.status_code == 422  # Недопустимый размер страницы
+
+
+@pytest.mark.asyncio
+async def test_get_wallets_batch(client, bearer_key):
+    """Тестирование эндпоинта GET /api/v1/wallets/batch"""
+    # Предварительная подготовка данных в базе
+    async with TestSessionLocal() as session:
+        session.add_all([
+            Wallet(UUID='1a88911f-3345-4963-bd73-0f76dbf27a1d', amount=100.0),
+            Wallet(UUID='2b88911f-3345-4963-bd73-0f76dbf27a2b', amount=200.0),
+            Wallet(UUID='3c88911f-3345-4963-bd73-0f76dbf27a3c', amount=300.0),
+        ])
+        await session.commit()
+
+    response = await client.get(
+        "/api/v1/wallets/batch",
+        params={"uuids": ['1a88911f-3345-4963-bd73-0f76dbf27a1d',
+                          '3c88911f-3345-4963-bd73-0f76dbf27a3c',
+                          '0e81690e-d29f-4596-af25-d5ca43e48d3b']},
+        headers={"Authorization": bearer_key}
+    )
+
+    # Несуществующий UUID пропускается
+    assert response.status_code == 200
+    data = response.json()
+    assert sorted(wallet['UUID'] for wallet in data) == ['1a88911f-3345-4963-bd73-0f76dbf27a1d',
+                                                         '3c88911f-3345-4963-bd73-0f76dbf27a3c']
+
+    response = await client.get(
+        "/api/v1/wallets/batch",
+        params={"uuids": ['invalid-uuid']},
+        headers={"Authorization": bearer_key}
+    )
+
+    assert response.status_code == 422  # Неверный формат UUID
+
+
+@pytest.mark.asyncio
+async def test_scoped_session_registry(client, bearer_key):
+    """Тестирование get_session: сессии задач закрываются и убираются из реестра"""
+    async with TestSessionLocal() as session:
+        session.add(Wallet(UUID='4d88911f-3345-4963-bd73-0f76dbf27a4d', amount=100.0))
+        await session.commit()
+
+    # Настоящий get_session поверх тестовой базы
+    test_scoped_session = async_scoped_session(TestSessionLocal, scopefunc=asyncio.current_task)
+    override = app.dependency_overrides.pop(get_session)
+    try:
+        with patch('app.main.scoped_session', test_scoped_session):
+            # Последовательные запросы
+            for _ in range(3):
+                response = await client.get(
+                    "/api/v1/wallets/4d88911f-3345-4963-bd73-0f76dbf27a4d",
+                    headers={"Authorization": bearer_key}
+                )
+                assert response.status_code == 200
+                assert test_scoped_session.registry.registry == {}
+
+            # Одновременные запросы
+            responses = await asyncio.gather(*(
+                client.post(
+                    "/api/v1/wallets/4d88911f-3345-4963-bd73-0f76dbf27a4d/operation",
+                    headers={"Authorization": bearer_key}, json={"operationType": "DEPOSIT", "amount": 1})
+                for _ in range(5)
+            ))
+            assert [response.status_code for response in responses] == [200] * 5
+            assert test_scoped_session.registry.registry == {}
+            # Все соединения вернулись в пул
+            assert test_engine.pool.checkedout() == 0
+    finally:
+        app.dependency_overrides[get_session] = override
+        # Закрываем оставшиеся в реестре сессии, чтобы они не заблокировали удаление таблиц
+        for session in list(test_scoped_session.registry.registry.values()):
+            await session.close()
+
+    async with TestSessionLocal() as session:
+        result = await session.execute(select(Wallet.amount))
+        assert result.scalar_one() == 105
+
+
+@pytest.mark.asyncio
+async def test_warm_up_pool_failure(setup_database):
+    """Тестирование прогрева пула: при ошибке подключения открытые соединения закрываются"""
+
+    class FlakyEngine:
+        """ Третье подключение падает, остальные идут в тестовую базу """
+        calls = 0
+
+        def connect(self):
+            self.calls += 1
+            if self.calls == 3:
+                return failing_connect()
+            return test_engine.connect()
+
+    @asynccontextmanager
+    async def failing_connect():
+        raise OSError("Подключение отклонено")
+        yield
+
+    with (patch('app.db.engine', FlakyEngine()), patch('app.db.pool_size', 5),
+          warnings.catch_warnings(record=True) as caught):
+        warnings.simplefilter('always')
+        with pytest.raises(Exception):
+            await warm_up_pool()
+        # Даём завершиться возможным подключениям, оставшимся в работе
+        await asyncio.sleep(0.5)
+
+    # Ни одно соединение не осталось открытым и не было подобрано сборщиком мусора
+    assert test_engine.pool.checkedout() == 0
+    assert not [warning for warning in caught if issubclass(warning.category, SAWarning)]
+
+
 @pytest.mark.asyncio
 async def test_get_uuid_not_found(client, bearer_key):
     """Тестирование GET /api/v1/wallets/{wallet_uuid} для неверного UUID кошелька"""
@@ -124,7 +311,7 @@ async def test_get_uuid_not_found(client, bearer_key):
 
     assert response.status_code == 422  # Неверный формат UUID
     data = response.json()
-    assert data['detail'] == 'Неверный формат UUID'
+    assert data['detail'][0]['loc'] == ['path', 'wallet_uuid']
 
 
 @pytest.mark.asyncio
@@ -202,6 +389,76 @@ async def test_operations(client, bearer_key):
     assert data['detail'] == 'Недостаточно средств для снятия'
 
 
+@pytest.mark.asyncio
+async def test_withdraw_without_check_constraint(client, bearer_key):
+    """Тестирование списания сверх остатка, если в базе нет CHECK-ограничения"""
+    async with TestSessionLocal() as session:
+        # Таблица, созданная до появления ограничения
+        await session.execute(text('ALTER TABLE wallets DROP CONSTRAINT ck_amount_nonneg'))
+        session.add(Wallet(UUID='8b88911f-3345-4963-bd73-0f76dbf27a8b', amount=100.0))
+        await session.commit()
+
+    response = await client.post(
+        "/api/v1/wallets/8b88911f-3345-4963-bd73-0f76dbf27a8b/operation",
+        headers={"Authorization": bearer_key}, json={"operationType": "WITHDRAW", "amount": 150})
+
+    assert response.status_code == 400  # Недостаточно средств
+    data = response.json()
+    assert data['detail'] == 'Недостаточно средств для снятия'
+
+    async with TestSessionLocal() as session:
+        result = await session.execute(select(Wallet.amount))
+        assert result.scalar_one() == 100  # Баланс не изменился
+
+
+@pytest.mark.asyncio
+async def test_check_constraint(setup_database):
+    """Тестирование CHECK-ограничения: база не допускает отрицательный баланс"""
+    async with TestSessionLocal() as session:
+        session.add(Wallet(UUID='9c88911f-3345-4963-bd73-0f76dbf27a9c', amount=100.0))
+        await session.commit()
+
+        with pytest.raises(IntegrityError) as exc_info:
+            await session.execute(text('UPDATE wallets SET amount = -1'))
+
+    assert exc_info.value.orig.sqlstate == '23514'
+
+
+@pytest.mark.asyncio
+async def test_operation_non_positive_amount(client, bearer_key):
+    """Тестирование операций с нулевой и отрицательной суммой"""
+    async with TestSessionLocal() as session:
+        session.add(Wallet(UUID='9c88911f-3345-4963-bd73-0f76dbf27a9c', amount=100.0))
+        await session.commit()
+
+    for operation_type in ('DEPOSIT', 'WITHDRAW'):
+        for amount in (0, -150):
+            response = await client.post(
+                "/api/v1/wallets/9c88911f-3345-4963-bd73-0f76dbf27a9c/operation",
+                headers={"Authorization": bearer_key}, json={"operationType": operation_type, "amount": amount})
+
+            assert response.status_code == 422
+            data = response.json()
+            assert data['detail'][0]['loc'] == ['body', 'amount']
+
+    async with TestSessionLocal() as session:
+        result = await session.execute(select(Wallet.amount))
+        assert result.scalar_one() == 100  # Баланс не изменился
+
+
+@pytest.mark.asyncio
+async def test_operation_wallet_not_found(client, bearer_key):
+    """Тестирование POST /api/v1/wallets/{wallet_uuid}/operation для несуществующего кошелька"""
+
+    response = await client.post(
+        "/api/v1/wallets/0e81690e-d29f-4596-af25-d5ca43e48d3b/operation",
+        headers={"Authorization": bearer_key}, json={"operationType": "WITHDRAW", "amount": 1})
+
+    assert response.status_code == 404  # UUID не найден
+    data = response.json()
+    assert data['detail'] == 'Кошелек не найден'
+
+
 @pytest.mark.asyncio
 async def test_operations_with_deadlock(client, bearer_key):
     """Тестирование обработки дедлоков"""
@@ -254,14 +511,18 @@ async def test_invalid_amount(client, bearer_key):
 
 
 @pytest.mark.asyncio
-async def test_get_wallet_invalid_uuid(setup_database):
-    """Тестирование функции get_wallet с неверным UUID"""
+async def test_operation_invalid_uuid(client, bearer_key):
+    """Тестирование POST /api/v1/wallets/{wallet_uuid}/operation с неверным UUID"""
 
-    with pytest.raises(HTTPException) as exc_info:
-        await get_wallet(wallet_uuid="invalid-uuid", db=setup_database)
+    response = await client.post(
+        "/api/v1/wallets/invalid-uuid/operation",
+        headers={"Authorization": bearer_key},
+        json={"operationType": "DEPOSIT", "amount": '50'}
+    )
 
-    assert exc_info.value.status_code == 422
-    assert exc_info.value.detail == 'Неверный формат UUID'
+    assert response.status_code == 422  # Неверный формат UUID
+    data = response.json()
+    assert data['detail'][0]['loc'] == ['path', 'wallet_uuid']
 
 
 @pytest.mark.asyncio
@@ -277,8 +538,8 @@ async def test_operation_with_operational_error(client, bearer_key):
         session.add(wallet)
         await session.commit()
 
-    with patch('app.main.select') as mocked_select:
-        mocked_select.side_effect = OperationalError("Ошибка операции", params=None, orig=None)  # type:ignore
+    with patch('app.main.update') as mocked_update:
+        mocked_update.side_effect = OperationalError("Ошибка операции", params=None, orig=None)  # type:ignore
 
         response = await client.post(
             "/api/v1/wallets/5e88911f-3345-4963-bd73-0f76dbf27a5e/operation",
@@ -291,6 +552,67 @@ async def test_operation_with_operational_error(client, bearer_key):
         assert data['detail'] == 'Произошла ошибка при обработке операции'
 
 
+@pytest.mark.asyncio
+async def test_operation_retry_on_deadlock(client, bearer_key):
+    """Тестирование повтора операции после дедлока"""
+
+    # Предварительная подготовка данных в базе
+    async with TestSessionLocal() as session:
+        wallet = Wallet(
+            UUID='7a88911f-3345-4963-bd73-0f76dbf27a7a',
+            amount=100.0
+        )
+        session.add(wallet)
+        await session.commit()
+
+    class DeadlockDetected(Exception):
+        sqlstate = '40P01'
+
+    deadlock = DBAPIError("Дедлок", params=None, orig=DeadlockDetected())  # type:ignore
+    with patch('app.main.update', side_effect=[deadlock, update(Wallet)]):
+        response = await client.post(
+            "/api/v1/wallets/7a88911f-3345-4963-bd73-0f76dbf27a7a/operation",
+            headers={"Authorization": bearer_key},
+            json={"operationType": "WITHDRAW", "amount": '50'}
+        )
+
+    # Вторая попытка проходит успешно
+    assert response.status_code == 200
+    data = response.json()
+    assert data['amount'] == '50.00'
+
+
+@pytest.mark.asyncio
+async def test_operation_retries_exhausted(client, bearer_key):
+    """Тестирование исчерпания попыток при повторяющихся дедлоках"""
+
+    # Предварительная подготовка данных в базе
+    async with TestSessionLocal() as session:
+        wallet = Wallet(
+            UUID='7a88911f-3345-4963-bd73-0f76dbf27a7a',
+            amount=100.0
+        )
+        session.add(wallet)
+        await session.commit()
+
+    class DeadlockDetected(Exception):
+        sqlstate = '40P01'
+
+    deadlock = DBAPIError("Дедлок", params=None, orig=DeadlockDetected())  # type:ignore
+    with patch('app.main.update', side_effect=deadlock) as mocked_update:
+        response = await client.post(
+            "/api/v1/wallets/7a88911f-3345-4963-bd73-0f76dbf27a7a/operation",
+            headers={"Authorization": bearer_key},
+            json={"operationType": "WITHDRAW", "amount": '50'}
+        )
+
+    # Все 5 попыток завершились дедлоком
+    assert mocked_update.call_count == 5
+    assert response.status_code == 500
+    data = response.json()
+    assert data['detail'] == 'Системная ошибка, попробуйте позже'
+
+
 @pytest.mark.asyncio
 async def test_operation_with_sqlalchemy_error(client, bearer_key):
     """Тестирование обработки SQLAlchemyError при выполнении операции"""
@@ -304,8 +626,8 @@ async def test_operation_with_sqlalchemy_error(client, bearer_key):
         session.add(wallet)
         await session.commit()
 
-    with patch('app.main.select') as mocked_select:
-        mocked_select.side_effect = SQLAlchemyError()
+    with patch('app.main.update') as mocked_update:
+        mocked_update.side_effect = SQLAlchemyError()
 
         response = await client.post(
             "/api/v1/wallets/6f88911f-3345-4963-bd73-0f76dbf27a6f/operation",